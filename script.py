@@ -1,148 +1,403 @@
 import os
-import json
-import shlex
 import subprocess
-import re
-import time
-from groq import Groq
-from groq._base_client import APIStatusError
+import hashlib
+import shutil
+import tempfile
+import asyncio
+import csv
+from contextlib import nullcontext
+from groq import APIConnectionError, APIStatusError, RateLimitError
+from srt_utils import (
+    BACKOFF_BASE,
+    extract_retry_time,
+    get_client,
+    next_backoff,
+    read_json,
+    retry_time_from_headers,
+    run_command,
+    stream_command_lines,
+    write_json,
+    write_srt,
+)
 
 # Directories configuration
 VIDEO_DIR = "./"
 AUDIO_DIR = os.path.join(VIDEO_DIR, "audio")
 JSON_DIR = os.path.join(VIDEO_DIR, "json")
 SRT_DIR = os.path.join(VIDEO_DIR, "srt")
+# Groq results keyed by audio hash; kept across runs and never pruned, delete to reset
+CACHE_DIR = os.path.join(VIDEO_DIR, ".transcription_cache")
+
+# Video file extensions to process, lowercase and without the dot
+VIDEO_SUFFIXES = frozenset({"mp4", "mkv", "avi"})
 
 # Ensure output directories exist
 os.makedirs(AUDIO_DIR, exist_ok=True)
 os.makedirs(JSON_DIR, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
 os.makedirs(SRT_DIR, exist_ok=True)
 
+# Maximum number of files waiting between two pipeline stages
+QUEUE_SIZE = 2
+# Number of ffmpeg processes run in parallel, and threads given to each
+EXTRACT_CONCURRENCY = max(1, (os.cpu_count() or 1) // 2)
+FFMPEG_THREADS = 2
+# Maximum number of concurrent Groq transcription requests
+TRANSCRIBE_CONCURRENCY = 4
+# Length in seconds of each audio segment sent to Groq
+SEGMENT_TIME = 600
+
+# Put on a video's segment queue when its audio extraction failed
+EXTRACTION_FAILED = object()
+
+# Groq transcription settings, also part of the transcription cache key
+TRANSCRIPTION_MODEL = "whisper-large-v3"
+TRANSCRIPTION_LANGUAGE = "ko"
+TRANSCRIPTION_FORMAT = "verbose_json"
+
 
-def run_command(command):
-    """Run a shell command."""
+def ffmpeg_audio_command(video_file_path):
+    """Return the ffmpeg arguments that encode a video's audio track, minus the output."""
+    return [
+        "ffmpeg", "-v", "error", "-nostdin", "-y", "-i", video_file_path,
+        "-vn", "-ar", "16000", "-ac", "1", "-b:a", "46k",
+        "-fflags", "+bitexact", "-threads", str(FFMPEG_THREADS),
+    ]
+
+
+async def probe_duration(video_file_path):
+    """Return the duration of a media file in seconds, or None if unknown."""
+    ffprobe_command = [
+        "ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", video_file_path
+    ]
+    output = await run_command(ffprobe_command, capture_output=True)
     try:
-        subprocess.run(shlex.split(command), check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"Command failed: {command}")
-        raise e
+        return float(output)
+    except ValueError:
+        return None
+
+
+async def extract_audio_to_memory(video_file_path):
+    """Extract audio in WebM format straight from ffmpeg's stdout, without a temp file."""
+    ffmpeg_command = ffmpeg_audio_command(video_file_path) + ["-f", "webm", "pipe:1"]
+    print(f"Extracting audio: {video_file_path} -> memory")
+    return await run_command(ffmpeg_command, capture_output=True)
 
 
-def convert_video_to_audio(video_file_path):
-    """Convert video to audio in WebM format, optimized for size and quality."""
+def split_dir_for(base_name):
+    """Return the directory holding a video's audio segments."""
+    return os.path.join(AUDIO_DIR, base_name)
+
+
+async def extract_and_maybe_segment(video_file_path):
+    """Extract audio in WebM format and split it into segments in one ffmpeg pass.
+
+    Yields (audio, start) pairs in playback order, where start is the offset in
+    seconds of the audio within the video. Each segment file's path is yielded
+    as soon as ffmpeg has finished writing it. Videos no longer than one
+    segment are kept in memory instead and yielded as a single
+    (filename, bytes) pair.
+    """
     base_name = os.path.splitext(os.path.basename(video_file_path))[0]
-    audio_path = os.path.join(AUDIO_DIR, f"{base_name}.webm")
-    ffmpeg_command = (
-        f"ffmpeg -i {shlex.quote(video_file_path)} -vn -ar 16000 -ac 1 -b:a 46k "
-        f"{shlex.quote(audio_path)}"
-    )
-    print(f"Extracting audio: {video_file_path} -> {audio_path}")
-    run_command(ffmpeg_command)
-    return audio_path
-
-
-def extract_retry_time(error_message):
-    """Extract retry time from rate limit error message."""
-    match = re.search(r"Please try again in (\d+h)?(\d+m)?(\d+\.\d+s)?", error_message)
-    if match:
-        hours = int(match.group(1)[:-1]) if match.group(1) else 0
-        minutes = int(match.group(2)[:-1]) if match.group(2) else 0
-        seconds = float(match.group(3)[:-1]) if match.group(3) else 0
-        return int(hours * 3600 + minutes * 60 + seconds)
-    return 60  # Default to 60 seconds if no time is found
-
-
-def transcribe_audio_with_groq(audio_path, json_output_path):
-    """Send audio file to Groq API for transcription."""
-    print(f"Transcribing {audio_path} -> {json_output_path}...")
-    client = Groq()
-    retry_count = 0
-    max_retries = 5
-
-    while retry_count < max_retries:
+    duration = await probe_duration(video_file_path)
+    if duration is not None and duration <= SEGMENT_TIME:
+        yield (f"{base_name}.webm", await extract_audio_to_memory(video_file_path)), 0.0
+        return
+
+    split_dir = split_dir_for(base_name)
+    os.makedirs(split_dir, exist_ok=True)
+    # "%" is special in ffmpeg's segment filename pattern
+    segment_pattern = os.path.join(split_dir, base_name.replace("%", "%%") + "-%03d.webm")
+    # ffmpeg lists each segment on stdout as "filename,start,end" once the
+    # segment file is complete. Segments are cut at packet boundaries, so the
+    # listed start is used rather than a multiple of SEGMENT_TIME.
+    ffmpeg_command = ffmpeg_audio_command(video_file_path) + [
+        "-f", "segment", "-segment_time", str(SEGMENT_TIME), "-reset_timestamps", "1",
+        "-segment_list", "pipe:1", "-segment_list_type", "csv", segment_pattern,
+    ]
+    print(f"Extracting audio: {video_file_path} -> {split_dir}")
+    async for line in stream_command_lines(ffmpeg_command):
+        segment_file, start, _ = next(csv.reader([line]))
+        yield os.path.join(split_dir, os.path.basename(segment_file)), float(start)
+
+
+def transcription_cache_path(audio):
+    """Return the cache file for an audio file path or (filename, bytes) pair.
+
+    Transcriptions are keyed on the SHA-256 of the audio and the Groq settings.
+    """
+    if isinstance(audio, str):
+        with open(audio, "rb") as file:
+            digest = hashlib.file_digest(file, "sha256").hexdigest()
+    else:
+        digest = hashlib.sha256(audio[1]).hexdigest()
+    cache_name = f"{digest}-{TRANSCRIPTION_MODEL}-{TRANSCRIPTION_LANGUAGE}-{TRANSCRIPTION_FORMAT}.json"
+    return os.path.join(CACHE_DIR, cache_name)
+
+
+def store_cached_transcription(data, cache_path):
+    """Write a transcription to the cache atomically.
+
+    Data goes to a temporary file in CACHE_DIR that is then renamed into place,
+    so an interrupted write never leaves a truncated cache entry behind.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    os.close(fd)
+    try:
+        write_json(data, temp_path)
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def link_cached_transcription(cache_path, json_output_path):
+    """Expose a cached transcription at json_output_path, hard-linking when possible."""
+    if os.path.exists(json_output_path):
+        os.remove(json_output_path)
+    try:
+        os.link(cache_path, json_output_path)
+    except OSError:
+        shutil.copyfile(cache_path, json_output_path)
+
+
+async def transcribe_audio_with_groq(audio, json_output_path):
+    """Send audio to Groq API for transcription. Returns True on success.
+
+    audio is either the path of an audio file or a (filename, bytes) pair
+    already held in memory. Audio that was transcribed before is served from
+    CACHE_DIR without calling Groq.
+    """
+    cache_path = await asyncio.to_thread(transcription_cache_path, audio)
+    if os.path.exists(cache_path):
+        print(f"Using cached transcription {cache_path} -> {json_output_path}.")
+        link_cached_transcription(cache_path, json_output_path)
+        return True
+
+    audio_name = audio if isinstance(audio, str) else audio[0]
+    print(f"Transcribing {audio_name} -> {json_output_path}...")
+    max_attempts = 5
+    wait_time = BACKOFF_BASE
+
+    for attempt in range(1, max_attempts + 1):
         try:
-            with open(audio_path, "rb") as audio_file:
-                transcription = client.audio.transcriptions.create(
-                    file=(audio_path, audio_file.read()),
-                    model="whisper-large-v3",
-                    language="ko",
-                    response_format="verbose_json",
+            # Files on disk are streamed into the upload rather than read into memory
+            with open(audio, "rb") if isinstance(audio, str) else nullcontext(audio[1]) as audio_content:
+                transcription = await get_client().audio.transcriptions.create(
+                    file=(os.path.basename(audio_name), audio_content, "audio/webm"),
+                    model=TRANSCRIPTION_MODEL,
+                    language=TRANSCRIPTION_LANGUAGE,
+                    response_format=TRANSCRIPTION_FORMAT,
                 )
-                with open(json_output_path, "w", encoding="utf-8") as json_file:
-                    json.dump(transcription.to_dict(), json_file, ensure_ascii=False, indent=4)
-                return  # Exit the function if successful
-        except APIStatusError as e:
+            store_cached_transcription(transcription.to_dict(), cache_path)
+            link_cached_transcription(cache_path, json_output_path)
+            return True  # Exit the function if successful
+        except RateLimitError as e:
             error_message = str(e)
-            print(f"Error: {error_message}")
-            if "rate limit reached" in error_message.lower():
+            print(f"Error on attempt {attempt}: {error_message}")
+            retry_after = retry_time_from_headers(e.response.headers)
+            if retry_after is None:
                 retry_after = extract_retry_time(error_message)
-                print(f"Rate limit reached. Retrying in {retry_after} seconds...")
-                time.sleep(retry_after)
-            else:
-                retry_count += 1
-                wait_time = 60 * retry_count
-                print(f"Unexpected APIStatusError. Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
+            if retry_after is None:
+                retry_after = wait_time = next_backoff(wait_time)
+            reason = "Rate limit reached."
+        except (APIStatusError, APIConnectionError) as e:
+            print(f"Error on attempt {attempt}: {e}")
+            retry_after = wait_time = next_backoff(wait_time)
+            reason = f"Unexpected {type(e).__name__}."
         except Exception as e:
             print(f"Unhandled error: {e}. Skipping file.")
+            return False
+        # Don't hold an upload slot waiting for a retry that will never happen
+        if attempt == max_attempts:
             break
-    print(f"Failed to transcribe {audio_path} after {max_retries} retries.")
+        print(f"{reason} Retrying in {retry_after:.1f} seconds...")
+        await asyncio.sleep(retry_after)
+    print(f"Failed to transcribe {audio_name} after {max_attempts} attempts.")
+    return False
 
 
-def seconds_to_srt_timestamp(seconds):
-    """Convert seconds to SRT timestamp format."""
-    milliseconds = int((seconds % 1) * 1000)
-    total_seconds = int(seconds)
-    hours, remainder = divmod(total_seconds, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    return f"{hours:02}:{minutes:02}:{seconds:02},{milliseconds:03}"
+def combine_json_segments(json_paths, offsets):
+    """Load per-segment transcriptions as one segment list, in playback order.
 
+    Each audio segment's timestamps start at 0, so they are shifted by the
+    segment's start offset in the video.
+    """
+    segments = []
+    for json_path, offset in zip(json_paths, offsets):
+        file_segments = read_json(json_path).get("segments", [])
+        if offset:
+            for segment in file_segments:
+                segment["start"] = segment.get("start", 0) + offset
+                segment["end"] = segment.get("end", 0) + offset
+        segments.extend(file_segments)
+    return segments
 
-def convert_json_to_srt(json_path, srt_path):
-    """Convert a JSON transcription file to SRT format."""
-    with open(json_path, "r", encoding="utf-8") as file:
-        data = json.load(file)
 
-    segments = data.get("segments", [])
-    srt_lines = []
+async def feed_stage(pending, extract_q):
+    """Pipeline stage: queue up the videos that still need subtitles."""
+    for item in pending:
+        await extract_q.put(item)
+    await extract_q.put(None)
 
-    for idx, segment in enumerate(segments, start=1):
-        start_time = seconds_to_srt_timestamp(segment.get("start", 0))
-        end_time = seconds_to_srt_timestamp(segment.get("end", 0))
-        text = segment.get("text", "")
-        srt_lines.append(f"{idx}\n{start_time} --> {end_time}\n{text}\n")
 
-    with open(srt_path, "w", encoding="utf-8") as file:
-        file.writelines(srt_lines)
+async def extract_stage(extract_q, transcribe_q):
+    """Pipeline stage: extract audio from queued videos, EXTRACT_CONCURRENCY at a time."""
 
+    async def extract_worker():
+        while (item := await extract_q.get()) is not None:
+            video_file, base_name = item
+            print(f"Processing {video_file}...")
+            # Hand the video on right away, so its segments are transcribed while
+            # ffmpeg is still writing later ones
+            audio_q = asyncio.Queue()
+            await transcribe_q.put((base_name, audio_q))
+            try:
+                async for segment in extract_and_maybe_segment(os.path.join(VIDEO_DIR, video_file)):
+                    await audio_q.put(segment)
+            except subprocess.CalledProcessError:
+                await audio_q.put(EXTRACTION_FAILED)
+            await audio_q.put(None)
+        # Pass the sentinel on so the other workers stop too
+        await extract_q.put(None)
 
-def process_video_files():
-    """Process all video files in the directory."""
-    video_files = [f for f in os.listdir(VIDEO_DIR) if f.lower().endswith((".mp4", ".mkv", ".avi"))]
+    await asyncio.gather(*(extract_worker() for _ in range(EXTRACT_CONCURRENCY)))
+    await transcribe_q.put(None)
+
+
+async def transcribe_stage(transcribe_q, srt_q):
+    """Pipeline stage: transcribe extracted audio files with Groq.
+
+    Segments of a video, and up to TRANSCRIBE_CONCURRENCY videos, are uploaded
+    concurrently, with at most TRANSCRIBE_CONCURRENCY requests in flight. Each
+    segment is uploaded as soon as extraction produces it. A rate-limited
+    request only delays its own segment.
+    """
+    video_slots = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+    upload_slots = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+
+    async def transcribe_segment(audio, json_path):
+        async with upload_slots:
+            return await transcribe_audio_with_groq(audio, json_path)
+
+    async def transcribe_one(base_name, audio_q):
+        try:
+            audio_files = []
+            json_paths = []
+            offsets = []
+            uploads = []
+            extraction_failed = False
+            while (item := await audio_q.get()) is not None:
+                if item is EXTRACTION_FAILED:
+                    extraction_failed = True
+                    continue
+                audio, offset = item
+                json_path = os.path.join(JSON_DIR, f"{base_name}-{len(json_paths):03}.json")
+                audio_files.append(audio)
+                json_paths.append(json_path)
+                offsets.append(offset)
+                uploads.append(asyncio.create_task(transcribe_segment(audio, json_path)))
+            if extraction_failed:
+                # The transcript would be incomplete, so stop uploading the rest
+                for upload in uploads:
+                    upload.cancel()
+            results = await asyncio.gather(*uploads, return_exceptions=True)
+            audio_paths = [audio for audio in audio_files if isinstance(audio, str)]
+            if extraction_failed or not all(result is True for result in results):
+                reason = "audio extraction failed" if extraction_failed else "not all segments were transcribed"
+                print(f"Skipping {base_name}, {reason}.")
+                remove_intermediates(base_name, audio_paths, [p for p in json_paths if os.path.exists(p)])
+            else:
+                await srt_q.put((base_name, audio_paths, json_paths, offsets))
+        finally:
+            video_slots.release()
+
+    tasks = []
+    while True:
+        # Take a slot before dequeuing so extraction stays bounded by the queue
+        await video_slots.acquire()
+        item = await transcribe_q.get()
+        if item is None:
+            video_slots.release()
+            break
+        tasks.append(asyncio.create_task(transcribe_one(*item)))
+    await asyncio.gather(*tasks)
+    await srt_q.put(None)
+
+
+def remove_intermediates(base_name, audio_paths, json_paths):
+    """Delete audio and JSON files of a video, and its split directory if any.
+
+    The split directory is removed with its contents, which includes any
+    partial segment left by a failed ffmpeg run.
+    """
+    for path in [*audio_paths, *json_paths]:
+        os.remove(path)
+    split_dir = split_dir_for(base_name)
+    if os.path.isdir(split_dir):
+        shutil.rmtree(split_dir)
+
+
+async def srt_stage(srt_q):
+    """Pipeline stage: write SRT files and clean up intermediates."""
+
+    def convert_to_srt(json_paths, offsets, srt_output_path):
+        write_srt(combine_json_segments(json_paths, offsets), srt_output_path)
+
+    while (item := await srt_q.get()) is not None:
+        base_name, audio_paths, json_paths, offsets = item
+        srt_output_path = os.path.join(SRT_DIR, f"{base_name}.srt")
+        await asyncio.to_thread(convert_to_srt, json_paths, offsets, srt_output_path)
+        print(f"SRT saved to {srt_output_path}.")
+
+        # Cleanup
+        remove_intermediates(base_name, audio_paths, json_paths)
+
+
+async def main():
+    """Process all video files in the directory.
+
+    Extraction, transcription and SRT writing run as concurrent stages
+    connected by bounded queues, so ffmpeg works on the next video while
+    the current one is being transcribed.
+    """
+    with os.scandir(VIDEO_DIR) as entries:
+        video_files = [
+            entry.name
+            for entry in entries
+            if entry.is_file() and entry.name.rpartition(".")[2].lower() in VIDEO_SUFFIXES
+        ]
     if not video_files:
         print("No video files found in the directory.")
         return
 
+    existing_srts = set(os.listdir(SRT_DIR))
+    # Intermediate and SRT paths are keyed on the base name, so only the first
+    # of e.g. "talk.mp4" and "talk.mkv" is processed
+    queued_base_names = set()
+    pending = []
     for video_file in video_files:
-        video_file_path = os.path.join(VIDEO_DIR, video_file)
         base_name = os.path.splitext(video_file)[0]
-        srt_output_path = os.path.join(SRT_DIR, f"{base_name}.srt")
 
-        if os.path.exists(srt_output_path):
+        if f"{base_name}.srt" in existing_srts:
             print(f"Skipping {video_file}, SRT already exists.")
             continue
+        if base_name in queued_base_names:
+            print(f"Skipping {video_file}, another video with base name {base_name} is already queued.")
+            continue
 
-        print(f"Processing {video_file}...")
-        audio_path = convert_video_to_audio(video_file_path)
-        json_output_path = os.path.join(JSON_DIR, f"{base_name}.json")
-        transcribe_audio_with_groq(audio_path, json_output_path)
-
-        convert_json_to_srt(json_output_path, srt_output_path)
-        print(f"SRT saved to {srt_output_path}.")
+        queued_base_names.add(base_name)
+        pending.append((video_file, base_name))
 
-        # Cleanup
-        os.remove(audio_path)
-        os.remove(json_output_path)
+    extract_q = asyncio.Queue(maxsize=QUEUE_SIZE)
+    transcribe_q = asyncio.Queue(maxsize=QUEUE_SIZE)
+    srt_q = asyncio.Queue(maxsize=QUEUE_SIZE)
+    await asyncio.gather(
+        feed_stage(pending, extract_q),
+        extract_stage(extract_q, transcribe_q),
+        transcribe_stage(transcribe_q, srt_q),
+        srt_stage(srt_q),
+    )
 
     print("Processing complete.")
     # Cleanup remaining directories
@@ -152,4 +407,4 @@ def process_video_files():
 
 
 if __name__ == "__main__":
-    process_video_files()
+    asyncio.run(main())
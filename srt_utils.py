@@ -0,0 +1,174 @@
+"""Helpers shared by the transcription scripts: commands, JSON, retries and SRT output."""
+import shlex
+import subprocess
+import re
+import random
+import asyncio
+import functools
+import numpy as np
+import httpx
+import orjson
+from groq import AsyncGroq, DefaultAsyncHttpxClient
+
+# Transcripts with at least this many segments get vectorized timestamp formatting
+VECTORIZE_MIN_SEGMENTS = 256
+
+# Bounds in seconds of the jittered backoff between failed Groq requests
+BACKOFF_BASE = 2
+BACKOFF_CAP = 120
+
+# Groq's duration notation, e.g. "1h2m3.5s" or "590ms"
+DURATION_PATTERN = r"(?:(\d+)h)?(?:(\d+)m(?!s))?(?:(\d+(?:\.\d+)?)ms)?(?:(\d+(?:\.\d+)?)s)?"
+DURATION_RE = re.compile(DURATION_PATTERN)
+# Wait time suggested by Groq's rate limit error message
+RETRY_TIME_RE = re.compile(r"Please try again in " + DURATION_PATTERN)
+
+
+@functools.cache
+def get_client():
+    """Return the Groq client shared by the whole run, creating it on first use.
+
+    Sharing it reuses connections across files, and HTTP/2 lets concurrent
+    uploads share a connection. Retries are handled by the callers, not by
+    the SDK.
+    """
+    return AsyncGroq(
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+        ),
+    )
+
+
+async def run_command(command, capture_output=False):
+    """Run a command, given as an argument list, without blocking the event loop.
+
+    The command's stdout is discarded, or returned as bytes with
+    capture_output. Its stderr is only shown if the command fails.
+    """
+    stdout = asyncio.subprocess.PIPE if capture_output else asyncio.subprocess.DEVNULL
+    process = await asyncio.create_subprocess_exec(*command, stdout=stdout, stderr=asyncio.subprocess.PIPE)
+    output, errors = await process.communicate()
+    if process.returncode != 0:
+        print(f"Command failed: {shlex.join(command)}")
+        print(errors.decode("utf-8", errors="replace"))
+        raise subprocess.CalledProcessError(process.returncode, command, output, errors)
+    return output
+
+
+async def stream_command_lines(command):
+    """Run a command, given as an argument list, yielding its stdout line by line.
+
+    Lines are yielded as soon as the command writes them. Its stderr is only
+    shown if the command fails.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    # Drain stderr alongside stdout so neither pipe can fill up and stall the command
+    errors = asyncio.create_task(process.stderr.read())
+    async for line in process.stdout:
+        yield line.decode("utf-8").rstrip("\n")
+    await process.wait()
+    if process.returncode != 0:
+        print(f"Command failed: {shlex.join(command)}")
+        print((await errors).decode("utf-8", errors="replace"))
+        raise subprocess.CalledProcessError(process.returncode, command, stderr=await errors)
+
+
+def read_file_bytes(path):
+    """Read a whole file in binary mode."""
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def read_json(path):
+    """Load a JSON file."""
+    return orjson.loads(read_file_bytes(path))
+
+
+def write_json(data, path):
+    """Write data to a JSON file as indented UTF-8."""
+    with open(path, "wb") as file:
+        file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+
+
+def duration_seconds(match):
+    """Convert a DURATION_PATTERN match to seconds."""
+    hours, minutes, milliseconds, seconds = match.groups()
+    return int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(milliseconds or 0) / 1000 + float(seconds or 0)
+
+
+def extract_retry_time(error_message):
+    """Extract retry time in seconds from rate limit error message, or None if there is none."""
+    match = RETRY_TIME_RE.search(error_message)
+    if match and any(match.groups()):
+        retry_after = duration_seconds(match)
+        if retry_after > 0:
+            return retry_after
+    return None
+
+
+def next_backoff(previous_wait):
+    """Pick the next retry wait using decorrelated jitter."""
+    return min(BACKOFF_CAP, random.uniform(BACKOFF_BASE, previous_wait * 3))
+
+
+def retry_time_from_headers(headers):
+    """Return the wait in seconds advertised by rate limit response headers, or None."""
+    try:
+        retry_after = float(headers.get("retry-after", 0))
+    except ValueError:  # HTTP-date form, not used by Groq
+        retry_after = 0
+    if retry_after > 0:
+        return retry_after
+    match = DURATION_RE.fullmatch(headers.get("x-ratelimit-reset-requests", ""))
+    if match and match[0]:
+        reset = duration_seconds(match)
+        if reset > 0:
+            return reset
+    return None
+
+
+def seconds_to_srt_timestamp(seconds):
+    """Convert seconds to SRT timestamp format."""
+    milliseconds = int((seconds % 1) * 1000)
+    total_seconds = int(seconds)
+    hours, remainder = divmod(total_seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours:02}:{minutes:02}:{seconds:02},{milliseconds:03}"
+
+
+def srt_timestamp_fields(seconds):
+    """Split an array of seconds into hour, minute, second and millisecond lists.
+
+    Vectorized counterpart of seconds_to_srt_timestamp, with the same truncation.
+    """
+    milliseconds = ((seconds % 1) * 1000).astype(np.int64)
+    hours, remainder = np.divmod(seconds.astype(np.int64), 3600)
+    minutes, seconds = np.divmod(remainder, 60)
+    return hours.tolist(), minutes.tolist(), seconds.tolist(), milliseconds.tolist()
+
+
+def write_srt(segments, srt_path):
+    """Write transcription segments to an SRT file."""
+    srt_lines = []
+
+    if len(segments) < VECTORIZE_MIN_SEGMENTS:
+        for idx, segment in enumerate(segments, start=1):
+            start_time = seconds_to_srt_timestamp(segment.get("start", 0))
+            end_time = seconds_to_srt_timestamp(segment.get("end", 0))
+            text = segment.get("text", "")
+            srt_lines.append(f"{idx}\n{start_time} --> {end_time}\n{text}\n")
+    else:
+        count = len(segments)
+        starts = np.fromiter((s.get("start", 0) for s in segments), dtype=np.float64, count=count)
+        ends = np.fromiter((s.get("end", 0) for s in segments), dtype=np.float64, count=count)
+        texts = [s.get("text", "") for s in segments]
+        rows = zip(range(1, count + 1), *srt_timestamp_fields(starts), *srt_timestamp_fields(ends), texts)
+        srt_lines = ["%d\n%02d:%02d:%02d,%03d --> %02d:%02d:%02d,%03d\n%s\n" % row for row in rows]
+
+    with open(srt_path, "wb") as file:
+        file.write("".join(srt_lines).encode("utf-8"))
+
@@ -0,0 +1,31 @@
+import pytest
+
+from srt_utils import extract_retry_time, retry_time_from_headers
+
+
+@pytest.mark.parametrize(
+    "message, expected",
+    [
+        ("Please try again in 590ms. Visit ...", 0.59),
+        ("Please try again in 1m2.5s. Visit ...", 62.5),
+        ("Please try again in 45s. Visit ...", 45.0),
+        ("Please try again in 1h2m3s. Visit ...", 3723.0),
+        ("Something else went wrong", None),
+    ],
+)
+def test_extract_retry_time(message, expected):
+    assert extract_retry_time(message) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        ({"retry-after": "3"}, 3.0),
+        ({"x-ratelimit-reset-requests": "6ms"}, 0.006),
+        ({"x-ratelimit-reset-requests": "2m59.56s"}, 179.56),
+        ({"x-ratelimit-reset-requests": "0s"}, None),
+        ({}, None),
+    ],
+)
+def test_retry_time_from_headers(headers, expected):
+    assert retry_time_from_headers(headers) == pytest.approx(expected)